@@ -1,10 +1,16 @@
-from typing import Dict, List, Any, Optional  # Added Optional
+from typing import Callable, Dict, List, Any, Optional, Tuple  # Added Optional
+import asyncio
+import json
 import os  # Added os
+import time
+
+import numpy as np
 
 # Ensure openai library is installed: pip install openai
 try:
     from openai import (
         OpenAI,
+        AsyncOpenAI,
         APIError,
     )  # Added APIError for specific exception handling
 except ImportError:
@@ -24,6 +30,26 @@ except ImportError:
 from ..utils.env_loader import EnvironmentLoader
 
 
+class _EmbeddingRows:
+    """Collect embeddings into one preallocated float32 (n, dim) matrix.
+
+    The matrix is allocated when the first vector arrives (the dimension is not
+    known before) and every vector is copied into its row as soon as its response
+    is parsed, so the Python float lists never pile up.
+    """
+
+    def __init__(self, count: int):
+        self.vectors: Optional[np.ndarray] = None
+        self.filled = np.zeros(count, dtype=bool)
+
+    def store(self, row: int, embedding: List[float]) -> None:
+        """Copy `embedding` into row `row` of the matrix."""
+        if self.vectors is None:
+            self.vectors = np.empty((len(self.filled), len(embedding)), dtype=np.float32)
+        self.vectors[row] = embedding
+        self.filled[row] = True
+
+
 class OpenAIEmbeddingGenerator:
     """Generate embeddings using OpenAI's API"""
 
@@ -60,6 +86,18 @@ class OpenAIEmbeddingGenerator:
         self.embedding_model = self.openai_config["embedding_model"]
         print(f"Using OpenAI embedding model: {self.embedding_model}", flush=True)
 
+    def create_async_client(self) -> AsyncOpenAI:
+        """Create an AsyncOpenAI client for the agenerate_* methods.
+
+        Its pooled connections are bound to the event loop that first uses them,
+        so create one per event loop (e.g. per `asyncio.run`) and close it when
+        that loop is done, e.g. with `async with`.
+        """
+        return AsyncOpenAI(
+            api_key=self.openai_config["api_key"],
+            base_url=self.openai_config.get("base_url"),
+        )
+
     def generate_embedding(self, text: str) -> List[float]:
         """Generate an embedding for a single text string.
 
@@ -153,7 +191,39 @@ class OpenAIEmbeddingGenerator:
             texts: List of texts to generate embeddings for.
 
         Returns:
-            List of embedding vectors (list of lists of floats). Returns empty list if input is empty.
+            List of embedding vectors (list of lists of floats), in the same order as `texts`.
+            Returns empty list if input is empty.
+
+        Raises:
+            APIError: If the OpenAI API call fails.
+            Exception: For other unexpected errors.
+        """
+        if not texts:
+            return []
+
+        embeddings: List[List[float]] = [None] * len(texts)
+        self._embed_in_batches(texts, embeddings.__setitem__)
+        return embeddings
+
+    async def agenerate_embeddings(
+        self,
+        texts: List[str],
+        concurrency: int = 8,
+        client: Optional[AsyncOpenAI] = None,
+    ) -> List[List[float]]:
+        """Generate embeddings for a list of text strings, sending batches concurrently.
+
+        Uses the same token-based batching as `generate_embeddings`, but up to
+        `concurrency` batch requests are in flight at once.
+
+        Args:
+            texts: List of texts to generate embeddings for.
+            concurrency: Maximum number of concurrent embedding requests.
+            client: Client from `create_async_client` to send the requests with;
+                if omitted, one is created and closed for this call.
+
+        Returns:
+            List of embedding vectors in the same order as `texts`. Returns empty list if input is empty.
 
         Raises:
             APIError: If the OpenAI API call fails.
@@ -162,10 +232,102 @@ class OpenAIEmbeddingGenerator:
         if not texts:
             return []
 
+        embeddings: List[List[float]] = [None] * len(texts)
+        await self._aembed_in_batches(texts, embeddings.__setitem__, concurrency, client)
+        return embeddings
+
+    def _embed_in_batches(
+        self, texts: List[str], store: Callable[[int, List[float]], None]
+    ) -> None:
+        """Embed texts batch by batch, passing each vector to `store` as soon as its response is parsed.
+
+        Texts are sent longest-first (see `_length_sorted_order`); `store` gets the
+        index of the text in `texts`, so callers never see the sorted order.
+
+        Args:
+            texts: List of texts to generate embeddings for
+            store: Called as store(index, embedding) for every text
+
+        Raises:
+            APIError: If the OpenAI API call fails
+            Exception: For other unexpected errors
+        """
+        order = self._length_sorted_order(texts)
+        position = 0
+        for batch in self._build_embedding_batches([texts[i] for i in order]):
+            for embedding in self._process_embedding_batch(batch):
+                store(order[position], embedding)
+                position += 1
+
+    async def _aembed_in_batches(
+        self,
+        texts: List[str],
+        store: Callable[[int, List[float]], None],
+        concurrency: int,
+        client: Optional[AsyncOpenAI] = None,
+    ) -> None:
+        """Async counterpart of `_embed_in_batches` with up to `concurrency` requests in flight.
+
+        Args:
+            texts: List of texts to generate embeddings for
+            store: Called as store(index, embedding) for every text
+            concurrency: Maximum number of concurrent embedding requests
+            client: Async client to use; if omitted, one is created and closed here
+
+        Raises:
+            APIError: If the OpenAI API call fails
+            Exception: For other unexpected errors
+        """
+        if client is None:
+            async with self.create_async_client() as client:
+                return await self._aembed_in_batches(texts, store, concurrency, client)
+
+        semaphore = asyncio.Semaphore(concurrency)
+        order = self._length_sorted_order(texts)
+
+        async def _embed_batch(start: int, batch: List[str]) -> None:
+            async with semaphore:
+                batch_embeddings = await self._aprocess_embedding_batch(batch, client)
+            for offset, embedding in enumerate(batch_embeddings):
+                store(order[start + offset], embedding)
+
+        batch_requests = []
+        start = 0  # Position of the batch's first text in the sorted order
+        for batch in self._build_embedding_batches([texts[i] for i in order]):
+            batch_requests.append(_embed_batch(start, batch))
+            start += len(batch)
+        await asyncio.gather(*batch_requests)
+
+    def _length_sorted_order(self, texts: List[str]) -> List[int]:
+        """Return text indices ordered longest-first.
+
+        Batching texts of similar size together packs each request closer to the
+        token limit, so the same input needs fewer (and more uniform) requests.
+
+        Args:
+            texts: List of texts to embed
+
+        Returns:
+            Indices into `texts`, sorted by text length in descending order
+        """
+        return sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+
+    def _build_embedding_batches(self, texts: List[str]) -> List[List[str]]:
+        """Split texts into batches that fit within the per-request token limit.
+
+        Empty strings are replaced with a single space, and any text that exceeds
+        the limit on its own is truncated and placed in a batch by itself.
+
+        Args:
+            texts: List of texts to batch
+
+        Returns:
+            List of batches, preserving the order of the input texts
+        """
         # Replace any empty strings with a single space
         processed_texts = [text if text else " " for text in texts]
 
-        all_embeddings = []
+        batches = []
         max_tokens_per_batch = 8192  # Maximum token limit for text-embedding-3-small
 
         # Create batches based on token count
@@ -188,24 +350,21 @@ class OpenAIEmbeddingGenerator:
                 truncated_text = encoding.decode(truncated_tokens)
 
                 if current_batch:
-                    # Process the current batch first
-                    batch_embeddings = self._process_embedding_batch(current_batch)
-                    all_embeddings.extend(batch_embeddings)
+                    # Close the current batch first
+                    batches.append(current_batch)
                     current_batch = []
                     current_batch_tokens = 0
 
-                # Process the truncated text as a single item batch
-                batch_embeddings = self._process_embedding_batch([truncated_text])
-                all_embeddings.extend(batch_embeddings)
+                # The truncated text goes in a single item batch
+                batches.append([truncated_text])
                 continue
 
-            # If adding this text would exceed the token limit, process the current batch first
+            # If adding this text would exceed the token limit, close the current batch first
             if (
                 current_batch_tokens + text_tokens > max_tokens_per_batch
                 and current_batch
             ):
-                batch_embeddings = self._process_embedding_batch(current_batch)
-                all_embeddings.extend(batch_embeddings)
+                batches.append(current_batch)
                 current_batch = []
                 current_batch_tokens = 0
 
@@ -213,18 +372,11 @@ class OpenAIEmbeddingGenerator:
             current_batch.append(text)
             current_batch_tokens += text_tokens
 
-        # Process any remaining texts in the last batch
+        # Keep any remaining texts in the last batch
         if current_batch:
-            batch_embeddings = self._process_embedding_batch(current_batch)
-            all_embeddings.extend(batch_embeddings)
-
-        # Final check: Ensure the number of embeddings matches the number of processed texts
-        if len(all_embeddings) != len(processed_texts):
-            print(
-                f"Warning: Final embedding count ({len(all_embeddings)}) does not match input text count ({len(processed_texts)}). Some batches may have failed."
-            )
+            batches.append(current_batch)
 
-        return all_embeddings
+        return batches
 
     def _process_embedding_batch(self, batch: List[str]) -> List[List[float]]:
         """Process a single batch of texts for embedding generation.
@@ -248,27 +400,7 @@ class OpenAIEmbeddingGenerator:
             response = self.client.embeddings.create(
                 model=self.embedding_model, input=batch, encoding_format="float"
             )
-
-            if response.data and len(response.data) == len(batch):
-                batch_embeddings = [item.embedding for item in response.data]
-                if not all(batch_embeddings):
-                    # Log which batch failed if possible
-                    print(
-                        f"Warning: Missing embedding data in response for batch {batch_index_info}."
-                    )
-                    # Handle missing embeddings - Option: fill with zero vectors of correct dimension
-                    # For now, we'll raise an error as before, but the error is now batch-specific.
-                    raise ValueError(
-                        f"Invalid response received from OpenAI API: Missing embedding data in batch {batch_index_info}."
-                    )
-                print(
-                    f"Successfully processed batch {batch_index_info}."
-                )  # Added success print
-                return batch_embeddings
-            else:
-                raise ValueError(
-                    f"Invalid response received from OpenAI API for batch {batch_index_info}: Mismatch in batch size or missing data. Expected {len(batch)}, got {len(response.data) if response.data else 0}."
-                )
+            return self._extract_batch_embeddings(response, batch, batch_index_info)
 
         except APIError as e:
             print(
@@ -285,21 +417,293 @@ class OpenAIEmbeddingGenerator:
             )
             raise  # Re-raise other exceptions
 
+    async def _aprocess_embedding_batch(
+        self, batch: List[str], client: AsyncOpenAI
+    ) -> List[List[float]]:
+        """Async counterpart of `_process_embedding_batch` using an AsyncOpenAI client.
+
+        Args:
+            batch: List of texts to generate embeddings for
+            client: Async client created by `create_async_client`
+
+        Returns:
+            List of embedding vectors for the batch
+
+        Raises:
+            APIError: If the OpenAI API call fails
+            Exception: For other unexpected errors
+        """
+        batch_index_info = f"(Batch of {len(batch)} texts)"  # For logging
+
+        try:
+            print(f"Generating embeddings for batch {batch_index_info}...")
+            response = await client.embeddings.create(
+                model=self.embedding_model, input=batch, encoding_format="float"
+            )
+            return self._extract_batch_embeddings(response, batch, batch_index_info)
+
+        except APIError as e:
+            print(
+                f"OpenAI API error generating embeddings for batch {batch_index_info}: {e}"
+            )
+            raise
+        except Exception as e:
+            print(
+                f"Unexpected error generating embeddings for batch {batch_index_info}: {e}"
+            )
+            raise
+
+    def _extract_batch_embeddings(
+        self, response: Any, batch: List[str], batch_index_info: str
+    ) -> List[List[float]]:
+        """Validate an embeddings API response and return its vectors.
+
+        Args:
+            response: Response returned by `embeddings.create`
+            batch: The texts that were sent in the request
+            batch_index_info: Batch description used in log and error messages
+
+        Returns:
+            List of embedding vectors for the batch
+
+        Raises:
+            ValueError: If the response is missing embeddings or has the wrong size
+        """
+        if response.data and len(response.data) == len(batch):
+            batch_embeddings = [item.embedding for item in response.data]
+            if not all(batch_embeddings):
+                # Log which batch failed if possible
+                print(
+                    f"Warning: Missing embedding data in response for batch {batch_index_info}."
+                )
+                # Handle missing embeddings - Option: fill with zero vectors of correct dimension
+                # For now, we'll raise an error as before, but the error is now batch-specific.
+                raise ValueError(
+                    f"Invalid response received from OpenAI API: Missing embedding data in batch {batch_index_info}."
+                )
+            print(
+                f"Successfully processed batch {batch_index_info}."
+            )  # Added success print
+            return batch_embeddings
+        else:
+            raise ValueError(
+                f"Invalid response received from OpenAI API for batch {batch_index_info}: Mismatch in batch size or missing data. Expected {len(batch)}, got {len(response.data) if response.data else 0}."
+            )
+
     def generate_node_embeddings(
         self, nodes: List[Dict[str, Any]]
-    ) -> List[Dict[str, Any]]:
-        """Generate embeddings for hierarchical nodes and add them to the node dictionaries.
+    ) -> Dict[Any, np.ndarray]:
+        """Generate embeddings for hierarchical nodes.
 
         Args:
             nodes: List of node dictionaries, each expected to have 'content' and optionally 'title'/'path'.
 
         Returns:
-            The same list of node dictionaries with an 'embedding' field added/updated.
-            Nodes where embedding generation fails might not have the 'embedding' key.
+            Mapping of each node's metadata['original_id'] to its embedding as a
+            float32 row view into one contiguous matrix. The nodes themselves are
+            not modified; nodes whose embedding failed (or that have no
+            original_id) are absent from the mapping.
         """
         if not nodes:
-            return []
+            return {}
+
+        texts_to_embed, original_indices = self._collect_node_texts(nodes)
+        if not texts_to_embed:
+            return {}
+
+        # Generate embeddings in batch, copying each vector into the matrix as it arrives
+        rows = _EmbeddingRows(len(texts_to_embed))
+        try:
+            self._embed_in_batches(texts_to_embed, rows.store)
+        except Exception as e:
+            print(
+                f"Error generating batch embeddings for nodes: {e}. Proceeding without embeddings for affected nodes."
+            )
+            return {}
+
+        return self._map_node_embeddings(nodes, original_indices, rows)
+
+    async def agenerate_node_embeddings(
+        self,
+        nodes: List[Dict[str, Any]],
+        concurrency: int = 8,
+        client: Optional[AsyncOpenAI] = None,
+    ) -> Dict[Any, np.ndarray]:
+        """Async counterpart of `generate_node_embeddings` with concurrent batch requests.
+
+        Args:
+            nodes: List of node dictionaries, each expected to have 'content' and optionally 'title'/'path'.
+            concurrency: Maximum number of concurrent embedding requests.
+            client: Client from `create_async_client` to send the requests with;
+                if omitted, one is created and closed for this call.
+
+        Returns:
+            Same return value as `generate_node_embeddings`.
+        """
+        if not nodes:
+            return {}
+
+        texts_to_embed, original_indices = self._collect_node_texts(nodes)
+        if not texts_to_embed:
+            return {}
+
+        rows = _EmbeddingRows(len(texts_to_embed))
+        try:
+            await self._aembed_in_batches(
+                texts_to_embed, rows.store, concurrency, client
+            )
+        except Exception as e:
+            print(
+                f"Error generating batch embeddings for nodes: {e}. Proceeding without embeddings for affected nodes."
+            )
+            return {}
+
+        return self._map_node_embeddings(nodes, original_indices, rows)
+
+    def generate_node_embeddings_batch_api(
+        self, nodes: List[Dict[str, Any]], poll_interval: float = 30.0
+    ) -> Dict[Any, np.ndarray]:
+        """Generate node embeddings through OpenAI's asynchronous Batch API.
+
+        Intended for large documents where latency is not critical: requests are
+        uploaded as one JSONL file and processed offline at a lower cost and with
+        higher rate limits than the realtime embeddings endpoint. Blocks until the
+        batch job finishes.
+
+        Args:
+            nodes: List of node dictionaries, each expected to have 'content' and optionally 'title'/'path'.
+            poll_interval: Seconds to wait between batch status checks.
 
+        Returns:
+            Same return value as `generate_node_embeddings`.
+
+        Raises:
+            RuntimeError: If the batch job does not complete successfully
+            APIError: If an OpenAI API call fails
+        """
+        if not nodes:
+            return {}
+
+        texts_to_embed, original_indices = self._collect_node_texts(nodes)
+        if not texts_to_embed:
+            return {}
+
+        rows = _EmbeddingRows(len(texts_to_embed))
+        # Errors propagate: a failed or expired job must not look like a
+        # document whose nodes all lack embeddings
+        self._run_embedding_batch_job(
+            texts_to_embed, rows.store, poll_interval=poll_interval
+        )
+
+        return self._map_node_embeddings(nodes, original_indices, rows)
+
+    def _run_embedding_batch_job(
+        self,
+        texts: List[str],
+        store: Callable[[int, List[float]], None],
+        poll_interval: float = 30.0,
+    ) -> None:
+        """Submit texts as a Batch API job and wait for the embeddings.
+
+        Args:
+            texts: List of texts to generate embeddings for
+            store: Called as store(index, embedding) for every request that
+                succeeded, while the output file is being read
+            poll_interval: Seconds to wait between batch status checks
+
+        Raises:
+            RuntimeError: If the batch job does not complete successfully
+            APIError: If an OpenAI API call fails
+        """
+        max_tokens = 8192  # Maximum token limit for embedding models
+        request_lines = []
+        for i, text in enumerate(texts):
+            request_lines.append(
+                json.dumps(
+                    {
+                        "custom_id": str(i),  # Index into texts, used to match results
+                        "method": "POST",
+                        "url": "/v1/embeddings",
+                        "body": {
+                            "model": self.embedding_model,
+                            "input": self._truncate_to_token_limit(text or " ", max_tokens),
+                            "encoding_format": "float",
+                        },
+                    }
+                )
+            )
+
+        batch_file = self.client.files.create(
+            file=("embeddings.jsonl", "\n".join(request_lines).encode("utf-8")),
+            purpose="batch",
+        )
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/embeddings",
+            completion_window="24h",
+        )
+        print(f"Submitted embedding batch {batch.id} with {len(texts)} requests.")
+
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(poll_interval)
+            batch = self.client.batches.retrieve(batch.id)
+            counts = batch.request_counts
+            progress = f" ({counts.completed}/{counts.total} done)" if counts else ""
+            print(f"Embedding batch {batch.id} status: {batch.status}{progress}")
+
+        if batch.status != "completed" or not batch.output_file_id:
+            raise RuntimeError(
+                f"Embedding batch {batch.id} ended with status '{batch.status}'."
+            )
+
+        # Stream the output file so only one result line is held at a time
+        with self.client.files.with_streaming_response.content(
+            batch.output_file_id
+        ) as output:
+            for line in output.iter_lines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get("response") or {}
+                data = (response.get("body") or {}).get("data") or []
+                if response.get("status_code") != 200 or not data:
+                    print(
+                        f"Warning: Batch request {result.get('custom_id')} failed: {result.get('error') or response.get('body')}"
+                    )
+                    continue
+                store(int(result["custom_id"]), data[0]["embedding"])
+
+    def _truncate_to_token_limit(self, text: str, max_tokens: int) -> str:
+        """Truncate text so it fits within `max_tokens` tokens.
+
+        Args:
+            text: The text to truncate
+            max_tokens: Maximum number of tokens to keep
+
+        Returns:
+            The original text if it fits, otherwise its first `max_tokens` tokens
+        """
+        token_count = self._count_tokens(text)
+        if token_count <= max_tokens:
+            return text
+
+        print(
+            f"Warning: Text with {token_count} tokens exceeds the maximum token limit ({max_tokens}). Truncating."
+        )
+        encoding = tiktoken.get_encoding("cl100k_base")
+        return encoding.decode(encoding.encode(text)[:max_tokens])
+
+    def _collect_node_texts(
+        self, nodes: List[Dict[str, Any]]
+    ) -> Tuple[List[str], List[int]]:
+        """Build the text to embed for each node that has content.
+
+        Args:
+            nodes: List of node dictionaries
+
+        Returns:
+            Tuple of (texts to embed, index of the node each text belongs to)
+        """
         texts_to_embed = []
         original_indices = []  # Keep track of which node corresponds to which text
 
@@ -319,37 +723,37 @@ class OpenAIEmbeddingGenerator:
                     f"Warning: Node {node.get('metadata', {}).get('original_id', i)} has empty content/title for embedding."
                 )
 
-        # Generate embeddings in batch if there are texts to process
-        embeddings = []
-        if texts_to_embed:
-            try:
-                embeddings = self.generate_embeddings(texts_to_embed)
-            except Exception as e:
-                print(
-                    f"Error generating batch embeddings for nodes: {e}. Proceeding without embeddings for affected nodes."
-                )
-                # In case of error, embeddings list will be empty or incomplete
+        return texts_to_embed, original_indices
 
-        # Add embeddings back to the corresponding nodes
-        embedding_map = dict(zip(original_indices, embeddings))
+    def _map_node_embeddings(
+        self,
+        nodes: List[Dict[str, Any]],
+        original_indices: List[int],
+        rows: _EmbeddingRows,
+    ) -> Dict[Any, np.ndarray]:
+        """Key generated embeddings by the original_id of the node they belong to.
 
-        for i, node in enumerate(nodes):
-            if i in embedding_map:
-                node["embedding"] = embedding_map[i]
-                # Ensure metadata exists
-                if "metadata" not in node:
-                    node["metadata"] = {}
-                # Indicate that an embedding was successfully generated and added
-                node["metadata"]["embedding_generated"] = True
-            else:
-                # Ensure metadata exists even if embedding failed
-                if "metadata" not in node:
-                    node["metadata"] = {}
-                node["metadata"]["embedding_generated"] = False
-                # Optionally add a zero vector or leave 'embedding' key absent
-                # node["embedding"] = [0.0] * 1536 # Example: Add zero vector
-
-            # We don't generate/store separate title embeddings as per the spec's note
-            # node["metadata"]["has_title_embedding"] = False # Explicitly state not used
+        Args:
+            nodes: List of node dictionaries
+            original_indices: Index of the node each matrix row belongs to
+            rows: Embedding matrix filled by the generation call; rows that
+                were never stored mark texts whose embedding failed
 
-        return nodes
+        Returns:
+            Mapping of metadata['original_id'] to a float32 embedding row for
+            every node whose embedding was generated successfully
+        """
+        if rows.vectors is None:
+            return {}
+
+        # Row views into one (N, dim) float32 block; pgvector stores float4 as
+        # well, so no precision is lost
+        keyed_embeddings: Dict[Any, np.ndarray] = {}
+        for row, i in enumerate(original_indices):
+            if not rows.filled[row]:
+                continue
+            original_id = nodes[i].get("metadata", {}).get("original_id")
+            if original_id is None:
+                continue  # Nothing to key the embedding by
+            keyed_embeddings[original_id] = rows.vectors[row]
+        return keyed_embeddings
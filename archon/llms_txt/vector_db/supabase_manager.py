@@ -116,6 +116,61 @@ class SupabaseManager:
             )
             raise  # Re-raise the exception
 
+    def insert_nodes_bulk(
+        self, nodes: List[Dict[str, Any]], batch_size: int = 500
+    ) -> List[Optional[int]]:
+        """Insert many nodes into the hierarchical_nodes table using array inserts
+
+        Nodes are sent in batches of `batch_size` rows, one round-trip per batch.
+        If a batch is rejected, its nodes are retried one at a time via
+        `insert_node` so a single bad row does not drop the whole batch.
+
+        Args:
+            nodes: List of node dictionaries matching the hierarchical_nodes schema
+            batch_size: Maximum number of rows sent per insert request
+
+        Returns:
+            The inserted node IDs, aligned with `nodes` (None for nodes that
+            failed to insert)
+        """
+        inserted_ids: List[Optional[int]] = []
+
+        for start in range(0, len(nodes), batch_size):
+            batch = nodes[start : start + batch_size]
+            for node in batch:
+                # Handle the metadata field properly - ensure it's a dict
+                if "metadata" not in node or not isinstance(node["metadata"], dict):
+                    node["metadata"] = {}
+
+            try:
+                response = (
+                    self.client.table("hierarchical_nodes").insert(batch).execute()
+                )
+                # Array inserts are atomic: either every row comes back, in
+                # insertion order, or none do
+                if response.data:
+                    inserted_ids.extend(row["id"] for row in response.data)
+                    continue
+                print(
+                    f"Bulk insert of {len(batch)} nodes returned no data. Falling back to single inserts.",
+                    flush=True,
+                )
+            except Exception as e:
+                print(
+                    f"Exception during bulk node insertion ({len(batch)} nodes): {e}. Falling back to single inserts.",
+                    flush=True,
+                )
+
+            # Fallback: insert the rejected batch row by row
+            for node in batch:
+                try:
+                    inserted_ids.append(self.insert_node(node))
+                except Exception:
+                    # insert_node already logged the failure details
+                    inserted_ids.append(None)
+
+        return inserted_ids
+
     def insert_reference(self, reference: Dict[str, Any]) -> int:
         """Insert a cross-reference into the hierarchical_references table
 
@@ -143,6 +198,56 @@ class SupabaseManager:
             print(f"Reference data: {json.dumps(reference, indent=2)}", flush=True)
             raise  # Re-raise the exception
 
+    def insert_references_bulk(
+        self, references: List[Dict[str, Any]], batch_size: int = 1000
+    ) -> int:
+        """Insert many cross-references into the hierarchical_references table
+
+        References are sent as array inserts of up to `batch_size` rows. If a
+        batch is rejected, its references are retried one at a time via
+        `insert_reference`. Callers are expected to deduplicate
+        (source_node_id, target_node_id) pairs beforehand, since the table has
+        no unique constraint to upsert against.
+
+        Args:
+            references: List of reference dictionaries matching the hierarchical_references schema
+            batch_size: Maximum number of rows sent per insert request
+
+        Returns:
+            The number of references successfully inserted
+        """
+        inserted_count = 0
+
+        for start in range(0, len(references), batch_size):
+            batch = references[start : start + batch_size]
+            try:
+                response = (
+                    self.client.table("hierarchical_references").insert(batch).execute()
+                )
+                if response.data:
+                    inserted_count += len(response.data)
+                    continue
+                print(
+                    f"Bulk insert of {len(batch)} references returned no data. Falling back to single inserts.",
+                    flush=True,
+                )
+            except Exception as e:
+                print(
+                    f"Exception during bulk reference insertion ({len(batch)} references): {e}. Falling back to single inserts.",
+                    flush=True,
+                )
+
+            # Fallback: insert the rejected batch row by row
+            for reference in batch:
+                try:
+                    self.insert_reference(reference)
+                    inserted_count += 1
+                except Exception:
+                    # insert_reference already logged the failure details
+                    continue
+
+        return inserted_count
+
     def vector_search(
         self,
         embedding: List[float],
@@ -275,6 +380,60 @@ class SupabaseManager:
             )
             return []
 
+    def find_nodes_by_paths(
+        self,
+        path_patterns: List[str],
+        document_id: str,
+        max_results_per_pattern: int = 10,
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """Find nodes of one document for many path patterns using a single RPC
+
+        Falls back to one `find_nodes_by_path` call per pattern if the RPC fails
+        (e.g. the function has not been created from utils/llms_txt.sql yet).
+
+        Args:
+            path_patterns: Text patterns to search in paths (matched with ILIKE '%pattern%')
+            document_id: Only nodes belonging to this document are returned
+            max_results_per_pattern: Maximum number of nodes returned per pattern
+
+        Returns:
+            Dictionary mapping each pattern to its matching nodes. Patterns without
+            matches are omitted (empty dict on error/no data).
+        """
+        nodes_by_pattern: Dict[str, List[Dict[str, Any]]] = {}
+        if not path_patterns:
+            return nodes_by_pattern
+
+        try:
+            response = self.client.rpc(
+                "find_nodes_by_paths",
+                {
+                    "path_patterns": list(path_patterns),
+                    "p_document_id": document_id,
+                    "max_results_per_pattern": max_results_per_pattern,
+                },
+            ).execute()
+        except Exception as e:
+            print(
+                f"Exception during batch path search RPC call ({len(path_patterns)} patterns): {e}. Falling back to single lookups.",
+                flush=True,
+            )
+            for pattern in path_patterns:
+                matches = [
+                    node
+                    for node in self.find_nodes_by_path(
+                        path_pattern=pattern, max_results=max_results_per_pattern
+                    )
+                    if node.get("document_id") == document_id
+                ]
+                if matches:
+                    nodes_by_pattern[pattern] = matches
+            return nodes_by_pattern
+
+        for row in response.data or []:
+            nodes_by_pattern.setdefault(row.pop("path_pattern"), []).append(row)
+        return nodes_by_pattern
+
     def get_full_subtree(self, root_node_id: int) -> List[Dict[str, Any]]:
         """Get the full subtree starting from a root node using RPC
 
@@ -306,8 +465,12 @@ class SupabaseManager:
             )
             return []
 
-    def update_node_parent(self, node_id: int, parent_id: Optional[int]) -> None:
-        """Update the parent_id of a specific node."""
+    def update_node_parent(self, node_id: int, parent_id: Optional[int]) -> bool:
+        """Update the parent_id of a specific node.
+
+        Returns:
+            True if the update succeeded, False otherwise
+        """
         try:
             response = (
                 self.client.table("hierarchical_nodes")
@@ -316,16 +479,99 @@ class SupabaseManager:
                 .execute()
             )
 
-            if response.error:
+            # Current clients raise on errors; older ones reported them on the response
+            error = getattr(response, "error", None)
+            if error:
                 print(
-                    f"Error updating parent for node {node_id}: {response.error}",
+                    f"Error updating parent for node {node_id}: {error}",
                     flush=True,
                 )
+                return False
             # else:
             #     print(f"Successfully updated parent for node {node_id} to {parent_id}")
+            return True
 
         except Exception as e:
             print(f"Exception updating parent for node {node_id}: {e}", flush=True)
+            return False
+
+    def bulk_update_parents(self, pairs: List[Tuple[int, int]]) -> int:
+        """Set the parent_id of many nodes with a single bulk_set_parents RPC call.
+
+        Falls back to one `update_node_parent` call per pair if the RPC fails
+        (e.g. the function has not been created from utils/llms_txt.sql yet).
+
+        Args:
+            pairs: List of (node_id, parent_id) tuples
+
+        Returns:
+            The number of parent links set
+        """
+        if not pairs:
+            return 0
+
+        try:
+            response = self.client.rpc(
+                "bulk_set_parents",
+                {
+                    "pairs": [
+                        {"id": node_id, "parent_id": parent_id}
+                        for node_id, parent_id in pairs
+                    ]
+                },
+            ).execute()
+            return response.data if isinstance(response.data, int) else len(pairs)
+        except Exception as e:
+            print(
+                f"Exception during bulk_set_parents RPC call ({len(pairs)} pairs): {e}. Falling back to single updates.",
+                flush=True,
+            )
+
+        # update_node_parent logs its own failures; count only the links that were set
+        return sum(
+            self.update_node_parent(node_id=node_id, parent_id=parent_id)
+            for node_id, parent_id in pairs
+        )
+
+    def build_references_for_document(
+        self,
+        document_id: str,
+        node_ids: List[int],
+        max_fuzzy_matches_per_path: int = 10,
+    ) -> int:
+        """Create a document's related-section references with one RPC call.
+
+        The build_references_for_document function joins each node's
+        metadata->'related_paths' against the paths of the document's nodes:
+        exact matches become 'related_section_exact' references (strength 0.9),
+        the remaining paths are matched with ILIKE as 'related_section_fuzzy'
+        references (strength 0.7).
+
+        Args:
+            document_id: Document whose nodes should be linked
+            node_ids: IDs of the nodes to consider; other rows of the document
+                (e.g. left over from a failed clear) are ignored
+            max_fuzzy_matches_per_path: Maximum fuzzy targets per related path
+
+        Returns:
+            The number of references created
+
+        Raises:
+            Exception: If the RPC call fails (e.g. the function has not been
+                created from utils/llms_txt.sql yet)
+        """
+        if not node_ids:
+            return 0
+
+        response = self.client.rpc(
+            "build_references_for_document",
+            {
+                "p_document_id": document_id,
+                "p_node_ids": node_ids,
+                "max_fuzzy_matches_per_path": max_fuzzy_matches_per_path,
+            },
+        ).execute()
+        return response.data if isinstance(response.data, int) else 0
 
     def delete_nodes_by_document_id(self, document_id: str) -> int:
         """Deletes all nodes associated with a specific document_id.
@@ -1,10 +1,15 @@
 import os
 import json
 import argparse
+import asyncio
+import logging
 import sys
+from dataclasses import dataclass
 from pathlib import Path
 from typing import Dict, List, Any, Optional, Set, Tuple
 
+import numpy as np
+
 # --- Import Pipeline Components ---
 try:
     # Phase 1-3 Components
@@ -21,7 +26,7 @@ try:
     from archon.llms_txt.vector_db.query_manager import HierarchicalQueryManager
     from archon.llms_txt.utils.env_loader import (
         EnvironmentLoader,
-    )  # Used implicitly by managers
+    )  # Shared loader passed to the managers
 
     # Phase 5 Components (Retrieval System)
     from archon.llms_txt.retrieval.retrieval_manager import RetrievalManager
@@ -47,8 +52,381 @@ except ImportError as e:
     sys.exit(1)
 
 
+logger = logging.getLogger(__name__)
+
+# Chunk metadata keys not copied into the node's metadata JSON: they are columns
+# in the main table or internal IDs. Add any other keys that become direct columns.
+_EXCLUDED_METADATA_KEYS = frozenset(
+    {
+        "hierarchy_path",
+        "section_type",
+        "content_type",
+        "document_position",
+        "parent_id",
+        "child_ids",
+        "sibling_ids",
+    }
+)
+
+# --- Phase 4 Pipeline Settings ---
+_PIPELINE_BATCH_SIZE = 256  # Nodes per micro-batch flowing through the pipeline
+_PIPELINE_QUEUE_SIZE = 4  # Max micro-batches buffered between stages
+_EMBED_WORKERS = 8  # Concurrent embedding requests
+_INSERT_WORKERS = 2  # Concurrent database writers
+
+
+def _to_path_str(related_path_item: Any) -> Optional[str]:
+    """Normalize a related_sections entry into the " > "-joined path key.
+
+    Returns:
+        The path string, or None if the entry is of an unsupported type.
+    """
+    if isinstance(related_path_item, list):
+        return " > ".join(map(str, related_path_item))
+    if isinstance(related_path_item, str):
+        return related_path_item
+    return None
+
+
+def _to_pgvector_literal(embedding: np.ndarray) -> str:
+    """Format a float32 embedding as a pgvector text literal, e.g. "[0.1,-0.2]".
+
+    Nine significant digits round-trip float32 exactly while staying shorter
+    than the JSON list of Python floats produced by ``tolist()``.
+    """
+    return "[" + ",".join(map("%.9g".__mod__, embedding.tolist())) + "]"
+
+
+async def _embed_and_insert_nodes(
+    db: SupabaseManager,
+    embedder: OpenAIEmbeddingGenerator,
+    nodes: List[Dict[str, Any]],
+    precomputed_embeddings: Optional[Dict[Any, np.ndarray]] = None,
+    clear_document_id: Optional[str] = None,
+) -> Tuple[Dict[Any, int], int]:
+    """Embeds and inserts nodes as an overlapping producer/consumer pipeline.
+
+    Micro-batches of nodes flow through a bounded queue into a pool of
+    embedding workers, which hand embedded batches to a second bounded queue
+    drained by database writers. Later batches are embedded while earlier
+    ones are being inserted, so wall-clock time approaches the slower stage
+    instead of the sum of both.
+
+    Args:
+        db: Database manager used for bulk inserts.
+        embedder: Embedding generator used for the async embedding calls.
+        nodes: Prepared node dicts, each carrying metadata["original_id"].
+        precomputed_embeddings: Embeddings keyed by original_id that were
+                      generated up front (e.g. via the Batch API). When given,
+                      the embedding stage only looks them up.
+        clear_document_id: If given, existing nodes of this document are deleted
+                      in a worker thread while the first batches are embedded;
+                      inserts wait for the delete to finish.
+
+    Returns:
+        A tuple of (mapping of original chunk ID to new database ID, number of
+        nodes that were skipped or failed to insert).
+    """
+    embed_queue: asyncio.Queue = asyncio.Queue(maxsize=_PIPELINE_QUEUE_SIZE)
+    insert_queue: asyncio.Queue = asyncio.Queue(maxsize=_PIPELINE_QUEUE_SIZE)
+    original_id_to_db_id: Dict[Any, int] = {}
+    failed_count = 0
+
+    async def produce() -> None:
+        for start in range(0, len(nodes), _PIPELINE_BATCH_SIZE):
+            await embed_queue.put(nodes[start : start + _PIPELINE_BATCH_SIZE])
+        for _ in range(_EMBED_WORKERS):
+            await embed_queue.put(None)  # One stop signal per worker
+
+    async def embed_worker() -> None:
+        nonlocal failed_count
+        while True:
+            batch = await embed_queue.get()
+            if batch is None:
+                break
+
+            if precomputed_embeddings is not None:
+                embeddings_by_id = precomputed_embeddings
+            else:
+                # One request in flight per worker; the pool size bounds total concurrency
+                embeddings_by_id = await embedder.agenerate_node_embeddings(
+                    batch, concurrency=1, client=async_client
+                )
+
+            ready_batch = []
+            for node in batch:
+                original_id = node.get("metadata", {}).get("original_id")
+                if not original_id:
+                    logger.debug(
+                        "Skipping node insertion due to missing original_id in metadata: %.100s...",
+                        node,
+                    )
+                    failed_count += 1
+                    continue
+
+                # Only insert nodes for which embedding was successful
+                embedding = embeddings_by_id.get(original_id)
+                if embedding is None:
+                    logger.debug(
+                        "Skipping insertion for node %s because embedding generation failed.",
+                        original_id,
+                    )
+                    failed_count += 1
+                    continue
+
+                # Attach the vector to a shallow copy so it is released together
+                # with the insert payload; serialize it only here, at the database
+                # boundary, as a compact literal that pgvector parses directly
+                ready_batch.append({**node, "embedding": _to_pgvector_literal(embedding)})
+
+            if ready_batch:
+                await insert_queue.put(ready_batch)
+
+    async def clear_existing_nodes() -> None:
+        if clear_document_id is None:
+            return
+        logger.info(f"Clearing existing nodes for document_id: {clear_document_id}...")
+        loop = asyncio.get_running_loop()
+        try:
+            deleted_count = await loop.run_in_executor(
+                None, db.delete_nodes_by_document_id, clear_document_id
+            )
+            logger.info(f"Cleared {deleted_count} existing nodes.")
+        except Exception as e:
+            # Proceed with the insert; stale rows are filtered out downstream
+            logger.error(
+                f"Error clearing existing nodes for document {clear_document_id}: {e}"
+            )
+
+    async def insert_worker() -> None:
+        nonlocal failed_count
+        while True:
+            batch = await insert_queue.get()
+            if batch is None:
+                break
+
+            # The delete must not overlap inserts, or it could remove new rows
+            await clear_task
+
+            # insert_nodes_bulk is blocking I/O; run it off the event loop
+            db_ids = await asyncio.to_thread(db.insert_nodes_bulk, batch)
+            # IDs come back aligned with the batch, None marking failed rows
+            ordered_original_ids = [node["metadata"]["original_id"] for node in batch]
+            original_id_to_db_id.update(
+                (original_id, db_id)
+                for original_id, db_id in zip(ordered_original_ids, db_ids)
+                if db_id is not None
+            )
+            failed_count += db_ids.count(None)
+
+    async def close_insert_queue(upstream: List[asyncio.Task]) -> None:
+        await asyncio.gather(*upstream)
+        for _ in range(_INSERT_WORKERS):
+            await insert_queue.put(None)  # One stop signal per writer
+
+    # One async client per run: its pooled connections belong to this event loop,
+    # so a client kept on the reused embedder would break the next asyncio.run()
+    async_client = (
+        embedder.create_async_client() if precomputed_embeddings is None else None
+    )
+
+    # Started first so the delete round-trip overlaps the embedding requests
+    clear_task = asyncio.create_task(clear_existing_nodes())
+    upstream_tasks = [asyncio.create_task(produce())] + [
+        asyncio.create_task(embed_worker()) for _ in range(_EMBED_WORKERS)
+    ]
+    tasks = [
+        clear_task,
+        *upstream_tasks,
+        asyncio.create_task(close_insert_queue(upstream_tasks)),
+        *(asyncio.create_task(insert_worker()) for _ in range(_INSERT_WORKERS)),
+    ]
+    # All stages are awaited together: the first failure cancels the rest, so a
+    # dead writer cannot leave the embedding workers blocked on a full queue
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        if async_client is not None:
+            await async_client.close()
+
+    return original_id_to_db_id, failed_count
+
+
+def _create_references_client_side(
+    db: SupabaseManager,
+    document_id: str,
+    related_paths_by_source: Dict[Any, List[str]],
+    path_to_original_id_map: Dict[str, Any],
+    original_id_to_db_id_map: Dict[Any, int],
+) -> Tuple[int, int]:
+    """Resolves related-section references in Python and bulk-inserts them.
+
+    Fallback for databases without the build_references_for_document function:
+    exact path matches are resolved locally, the remaining paths with one
+    find_nodes_by_paths lookup.
+
+    Args:
+        db: Database manager used for the lookup and the inserts.
+        document_id: Document whose freshly inserted nodes are linked.
+        related_paths_by_source: Normalized related paths per original chunk ID.
+        path_to_original_id_map: Exact node path to original chunk ID.
+        original_id_to_db_id_map: Original chunk ID to new database ID.
+
+    Returns:
+        A tuple of (references created, references that failed to insert).
+    """
+    # --- Resolve Exact References & Identify Fuzzy Paths ---
+    exact_resolved_references: Set[Tuple[Any, Any]] = (
+        set()
+    )  # Unique (source_orig_id, target_orig_id) pairs
+    paths_needing_fuzzy_lookup: Set[str] = set()  # Set of paths needing DB lookup
+    fuzzy_pending_references: List[Tuple[Any, str]] = (
+        []
+    )  # List of (source_orig_id, path_key_str) awaiting fuzzy lookup results
+    for source_original_id, related_paths in related_paths_by_source.items():
+        for path_key_str in related_paths:
+            target_original_id = path_to_original_id_map.get(path_key_str)
+            if target_original_id:
+                # Found exact match
+                if source_original_id != target_original_id:  # Avoid self-references
+                    exact_resolved_references.add(
+                        (source_original_id, target_original_id)
+                    )
+            else:
+                # No exact match, need fuzzy lookup (use the string key)
+                paths_needing_fuzzy_lookup.add(path_key_str)
+                fuzzy_pending_references.append((source_original_id, path_key_str))
+    logger.info(f"Found {len(exact_resolved_references)} exact references.")
+    logger.info(
+        f"Identified {len(paths_needing_fuzzy_lookup)} unique paths requiring fuzzy lookup."
+    )
+
+    # --- Batch Fuzzy Lookups ---
+    fuzzy_path_to_nodes_map: Dict[str, List[Dict[str, Any]]] = {}
+    if paths_needing_fuzzy_lookup:
+        try:
+            fuzzy_path_to_nodes_map = db.find_nodes_by_paths(
+                list(paths_needing_fuzzy_lookup),
+                document_id=document_id,
+                max_results_per_pattern=10,
+            )
+        except Exception as e_fuzzy:
+            logger.error(f"Error during batch fuzzy lookup: {e_fuzzy}")
+        logger.info(
+            f"Batch fuzzy lookups complete. Found nodes for {len(fuzzy_path_to_nodes_map)} of {len(paths_needing_fuzzy_lookup)} paths."
+        )
+
+    inserted_reference_pairs: Set[Tuple[int, int]] = (
+        set()
+    )  # Track (source_db_id, target_db_id)
+    refs_to_insert: List[Dict[str, Any]] = []  # Collected for a single bulk insert
+
+    # Process Exact Matches
+    for source_orig_id, target_orig_id in exact_resolved_references:
+        source_db_id = original_id_to_db_id_map.get(source_orig_id)
+        target_db_id = original_id_to_db_id_map.get(target_orig_id)
+
+        if source_db_id and target_db_id and source_db_id != target_db_id:
+            # Pairs are unique already (set of original IDs mapped one-to-one);
+            # record them so fuzzy matches do not duplicate an exact reference
+            refs_to_insert.append(
+                {
+                    "source_node_id": source_db_id,
+                    "target_node_id": target_db_id,
+                    "reference_type": "related_section_exact",  # Mark as exact
+                    "strength": 0.9,  # Higher strength for exact?
+                }
+            )
+            inserted_reference_pairs.add((source_db_id, target_db_id))
+
+    # Process Fuzzy Matches (after exact ones so exact pairs keep precedence)
+    # Fuzzy results are filtered by document_id, but rows from a failed clear could
+    # still match, so keep the membership check against a set of this run's IDs
+    db_ids_set: Set[int] = set(original_id_to_db_id_map.values())
+    for source_orig_id, path_key_str in fuzzy_pending_references:
+        source_db_id = original_id_to_db_id_map.get(source_orig_id)
+        if not source_db_id:
+            continue  # Skip if source node wasn't inserted
+
+        target_nodes = fuzzy_path_to_nodes_map.get(
+            path_key_str, []
+        )  # Already restricted to this document
+        for target_node in target_nodes:
+            target_db_id = target_node.get("id")
+            if (
+                target_db_id
+                and target_db_id in db_ids_set
+                and target_db_id != source_db_id
+            ):
+                ref_pair = (source_db_id, target_db_id)
+                if ref_pair not in inserted_reference_pairs:
+                    refs_to_insert.append(
+                        {
+                            "source_node_id": source_db_id,
+                            "target_node_id": target_db_id,
+                            "reference_type": "related_section_fuzzy",  # Mark as fuzzy
+                            "strength": 0.7,  # Lower strength for fuzzy?
+                        }
+                    )
+                    inserted_reference_pairs.add(ref_pair)
+
+    # Insert all collected references in one bulk call (batched internally)
+    if not refs_to_insert:
+        return 0, 0
+    references_created = db.insert_references_bulk(refs_to_insert)
+    return references_created, len(refs_to_insert) - references_created
+
+
+@dataclass
+class PipelineComponents:
+    """Parsers and database/embedding managers used by `process_document`.
+
+    Built once via `build_components` and reused across documents so HTTP
+    clients and configuration are not recreated per file.
+    """
+
+    processor: MarkdownProcessor
+    chunker: HierarchicalChunker
+    enricher: MetadataEnricher
+    db: SupabaseManager
+    embedder: OpenAIEmbeddingGenerator
+
+
+def build_components(
+    env_loader: Optional[EnvironmentLoader] = None,
+) -> PipelineComponents:
+    """Create the pipeline components.
+
+    Args:
+        env_loader: Loader for the managers' configuration. Defaults to a new
+                    loader for workbench/env_vars.json, read when this is called.
+
+    Returns:
+        A PipelineComponents instance ready to pass to `process_document`.
+    """
+    # Managers share one EnvironmentLoader so env_vars.json is read once per build
+    env_loader = env_loader or EnvironmentLoader(
+        env_file_path="../../workbench/env_vars.json"
+    )
+    return PipelineComponents(
+        processor=MarkdownProcessor(),
+        chunker=HierarchicalChunker(),
+        enricher=MetadataEnricher(),
+        db=SupabaseManager(env_loader=env_loader),
+        embedder=OpenAIEmbeddingGenerator(env_loader=env_loader),
+    )
+
+
 def process_document(
-    file_path: str, document_id: Optional[str] = None
+    file_path: str,
+    document_id: Optional[str] = None,
+    use_batch_api: bool = False,
+    components: Optional[PipelineComponents] = None,
 ) -> Optional[str]:
     """Processes a single markdown document through the full pipeline.
 
@@ -59,119 +437,121 @@ def process_document(
         file_path: Path to the markdown file to process.
         document_id: Optional unique identifier for the document. If None,
                      the filename (without extension) is used.
+        use_batch_api: If True, embeddings are generated through OpenAI's
+                       asynchronous Batch API (cheaper, but can take much
+                       longer) before the nodes are inserted.
+        components: Pipeline components to use. If None, a fresh set is built
+                    with `build_components`; pass one in when processing
+                    several documents to reuse clients across them.
 
     Returns:
         The document_id used for processing, or None if processing fails.
     """
-    print(f"Starting processing for document: {file_path}", flush=True)
+    logger.info(f"Starting processing for document: {file_path}")
 
     # --- Input Validation ---
     if not os.path.exists(file_path):
-        print(f"Error: File not found at {file_path}", flush=True)
+        logger.error(f"File not found at {file_path}")
         return None
     if not file_path.lower().endswith((".md", ".txt")):  # Allow .txt as well
-        print(
-            f"Warning: File {file_path} does not have a .md or .txt extension. Attempting to process anyway.",
-            flush=True,
+        logger.warning(
+            f"File {file_path} does not have a .md or .txt extension. Attempting to process anyway."
         )
 
     # --- Determine Document ID ---
     effective_document_id = (
         document_id or Path(file_path).stem
     )  # Use Pathlib for cleaner stem extraction
-    print(f"Using Document ID: {effective_document_id}", flush=True)
+    logger.info(f"Using Document ID: {effective_document_id}")
 
     # --- Initialize Components ---
-    # Components will use default EnvironmentLoader unless specific instances are needed
-    try:
-        print("Initializing components...", flush=True)
-        processor = MarkdownProcessor()
-        chunker = HierarchicalChunker()
-        enricher = MetadataEnricher()
-        db = (
-            SupabaseManager()
-        )  # Uses default env loader path (workbench/env_vars.json relative to root)
-        embedder = OpenAIEmbeddingGenerator()  # Uses default env loader path
-        print("Components initialized successfully.", flush=True)
-        # Perform a quick check of DB connection if desired
-        # db._check_tables() # Optional: Check tables exist before proceeding
-    except Exception as e:
-        print(f"Error initializing components: {e}", flush=True)
-        return None  # Cannot proceed if components fail to initialize
+    if components is None:
+        try:
+            logger.info("Initializing components...")
+            components = build_components()
+            logger.info("Components initialized successfully.")
+            # Perform a quick check of DB connection if desired
+            # components.db._check_tables() # Optional: Check tables exist before proceeding
+        except Exception as e:
+            logger.error(f"Error initializing components: {e}")
+            return None  # Cannot proceed if components fail to initialize
+    processor = components.processor
+    chunker = components.chunker
+    enricher = components.enricher
+    db = components.db
+    embedder = components.embedder
 
     # --- Read File Content ---
     try:
         with open(file_path, "r", encoding="utf-8") as f:
+            # markdown-it tokenizes a complete str, so the file is read in one go;
+            # isspace() avoids the full stripped copy that .strip() would build
             markdown_text = f.read()
-        if not markdown_text.strip():
-            print(
-                f"Warning: File {file_path} is empty or contains only whitespace.",
-                flush=True,
-            )
+        if not markdown_text or markdown_text.isspace():
+            logger.warning(f"File {file_path} is empty or contains only whitespace.")
             # Decide whether to proceed or return early for empty files
             return effective_document_id  # Or return None if empty docs shouldn't be processed
     except Exception as e:
-        print(f"Error reading file {file_path}: {e}", flush=True)
+        logger.error(f"Error reading file {file_path}: {e}")
         return None
 
     # --- Phase 1: Parse Document ---
     try:
-        print("Phase 1: Parsing document...", flush=True)
+        logger.info("Phase 1: Parsing document...")
         parsed_doc = processor.parse_document(markdown_text)
+        del markdown_text  # Tokens carry the content; release the raw text early
         # Assuming build_hierarchy_tree returns the root node of the tree structure
         doc_tree_root = processor.build_hierarchy_tree(parsed_doc)
         if not doc_tree_root:
-            print("Error: Document parsing or tree building failed.", flush=True)
+            logger.error("Document parsing or tree building failed.")
             return None
-        print("Phase 1: Document parsed successfully.", flush=True)
+        logger.info("Phase 1: Document parsed successfully.")
     except Exception as e:
-        print(f"Error during Phase 1 (Parsing): {e}", flush=True)
+        logger.error(f"Error during Phase 1 (Parsing): {e}")
         return None
 
     # --- Phase 2: Create Hierarchical Chunks ---
     try:
-        print("Phase 2: Creating hierarchical chunks...", flush=True)
+        logger.info("Phase 2: Creating hierarchical chunks...")
         # Assuming create_chunks takes the tree root and returns a flat list of chunk dicts
         chunks = chunker.create_chunks(doc_tree_root)
         if not chunks:
-            print("Warning: No chunks were created from the document.", flush=True)
-            # Decide if this is an error or just an empty doc case
-            # return None # Or proceed if 0 chunks is valid
-        print(f"Phase 2: Created {len(chunks)} chunks.", flush=True)
+            # Nothing to enrich, embed or store; skip the OpenAI and Supabase work
+            logger.warning("No chunks were created from the document.")
+            return effective_document_id
+        logger.info(f"Phase 2: Created {len(chunks)} chunks.")
     except Exception as e:
-        print(f"Error during Phase 2 (Chunking): {e}", flush=True)
+        logger.error(f"Error during Phase 2 (Chunking): {e}")
         return None
 
     # --- Phase 3: Enrich Chunks with Metadata ---
     try:
-        print("Phase 3: Enriching chunks with metadata...", flush=True)
+        logger.info("Phase 3: Enriching chunks with metadata...")
         # Call the correct method which processes all chunks
         enriched_chunks = enricher.process_chunks(
             chunks, doc_tree_root
         )  # Pass chunks and the document tree root
-        print("Phase 3: Metadata enrichment complete.", flush=True)
+        logger.info("Phase 3: Metadata enrichment complete.")
     except Exception as e:
-        print(f"Error during Phase 3 (Metadata Enrichment): {e}", flush=True)
+        logger.error(f"Error during Phase 3 (Metadata Enrichment): {e}")
         return None
 
     # --- Phase 4: Prepare Nodes & Pre-process References ---
-    print("Phase 4: Preparing nodes and pre-processing references...", flush=True)
+    logger.info("Phase 4: Preparing nodes and pre-processing references...")
     db_nodes_to_insert: List[Dict[str, Any]] = []
     original_id_to_chunk_map: Dict[Any, Dict[str, Any]] = (
         {}
     )  # Map original chunk ID to the full chunk data
     path_to_original_id_map: Dict[str, Any] = {}  # NEW: Map exact path to original ID
-    exact_resolved_references: List[Tuple[Any, Any]] = (
-        []
-    )  # NEW: List of (source_orig_id, target_orig_id)
-    paths_needing_fuzzy_lookup: Set[str] = set()  # NEW: Set of paths needing DB lookup
+    related_paths_by_source: Dict[Any, List[str]] = (
+        {}
+    )  # Map original chunk ID to its normalized related_sections paths
 
     for chunk in enriched_chunks:
         # Validate essential fields from previous phases
         if "id" not in chunk or "metadata" not in chunk:
-            print(
-                f"Warning: Skipping chunk due to missing 'id' or 'metadata': {str(chunk)[:100]}...",
-                flush=True,
+            logger.debug(
+                "Skipping chunk due to missing 'id' or 'metadata': %.100s...", chunk
             )
             continue
 
@@ -191,18 +571,7 @@ def process_document(
         metadata_payload = {
             k: v
             for k, v in chunk["metadata"].items()
-            # Exclude fields that are columns in the main table or internal IDs
-            if k
-            not in [
-                "hierarchy_path",
-                "section_type",
-                "content_type",
-                "document_position",
-                "parent_id",
-                "child_ids",
-                "sibling_ids",
-                # Add any other metadata keys that become direct columns
-            ]
+            if k not in _EXCLUDED_METADATA_KEYS
         }
         # Add original ID to metadata for tracking
         metadata_payload["original_id"] = original_id
@@ -210,6 +579,25 @@ def process_document(
         metadata_payload["link_count"] = chunk["metadata"].get("link_count")
         metadata_payload["contains_links"] = chunk["metadata"].get("contains_links")
 
+        # Normalize related_sections into unique path strings; stored in metadata
+        # so build_references_for_document can resolve them server-side
+        related_paths: List[str] = []
+        seen_paths: Set[str] = set()  # Duplicate entries resolve to the same refs
+        for related_path_item in chunk["metadata"].get("related_sections", []):
+            path_key_str = _to_path_str(related_path_item)
+            if path_key_str is None:
+                logger.debug(
+                    "Skipping unexpected type in related_sections: %s",
+                    type(related_path_item),
+                )
+                continue
+            if not path_key_str or path_key_str in seen_paths:
+                continue  # An empty path cannot identify a section
+            seen_paths.add(path_key_str)
+            related_paths.append(path_key_str)
+        metadata_payload["related_paths"] = related_paths
+        related_paths_by_source[original_id] = related_paths
+
         node_data = {
             "document_id": effective_document_id,
             "node_type": chunk.get("type", "unknown"),  # Default type if missing
@@ -223,7 +611,7 @@ def process_document(
                 "document_position"
             ),  # Can be None
             "metadata": metadata_payload,
-            # Embedding will be added next
+            # Embedding is attached to the insert payload in the pipeline
             # parent_id will be added after initial insertion
         }
         db_nodes_to_insert.append(node_data)
@@ -233,194 +621,72 @@ def process_document(
             path_to_original_id_map[path_str] = original_id
 
     if not db_nodes_to_insert:
-        print("No valid nodes prepared for database insertion.")
+        logger.warning("No valid nodes prepared for database insertion.")
         return effective_document_id  # Return ID even if no nodes inserted
 
-    # --- Resolve Exact References & Identify Fuzzy Paths ---
-    print(
-        "Phase 4: Resolving exact references and identifying fuzzy paths...", flush=True
-    )
-    for original_id, chunk_data in original_id_to_chunk_map.items():
-        source_original_id = original_id
-        related_sections = chunk_data.get("metadata", {}).get("related_sections", [])
-        for related_path_item in related_sections:  # Renamed variable
-            # FIX: Ensure the key used for lookup is always a string
-            if isinstance(related_path_item, list):
-                path_key_str = " > ".join(map(str, related_path_item))
-            elif isinstance(related_path_item, str):
-                path_key_str = related_path_item
-            else:
-                # Handle unexpected types if necessary, e.g., skip or log warning
-                print(
-                    f"Warning: Skipping unexpected type in related_sections: {type(related_path_item)}",
-                    flush=True,
-                )
-                continue
-
-            target_original_id = path_to_original_id_map.get(path_key_str)
-            if target_original_id:
-                # Found exact match
-                if source_original_id != target_original_id:  # Avoid self-references
-                    exact_resolved_references.append(
-                        (source_original_id, target_original_id)
-                    )
-            else:
-                # No exact match, need fuzzy lookup (use the string key)
-                paths_needing_fuzzy_lookup.add(path_key_str)
-    print(f"Found {len(exact_resolved_references)} exact references.", flush=True)
-    print(
-        f"Identified {len(paths_needing_fuzzy_lookup)} unique paths requiring fuzzy lookup.",
-        flush=True,
-    )
-
-    # --- Phase 4: Batch Fuzzy Lookups ---
-    print("Phase 4: Performing batch fuzzy lookups...", flush=True)
-    fuzzy_path_to_nodes_map: Dict[str, List[Dict[str, Any]]] = {}
-    fuzzy_lookup_errors = 0
-    for (
-        path_pattern
-    ) in paths_needing_fuzzy_lookup:  # path_pattern is now guaranteed to be a string
+    # --- Phase 4: Generate Embeddings via Batch API (Optional) ---
+    # Done before clearing so existing nodes stay queryable while the batch job runs
+    precomputed_embeddings: Optional[Dict[Any, np.ndarray]] = None
+    if use_batch_api:
         try:
-            # Use pattern matching, adjust max_results as needed (e.g., 10)
-            # Ensure path_pattern is treated as a string for the f-string
-            target_nodes_raw = db.find_nodes_by_path(
-                path_pattern=f"%{str(path_pattern)}%", max_results=10
+            logger.info("Phase 4: Submitting embeddings to the OpenAI Batch API...")
+            precomputed_embeddings = embedder.generate_node_embeddings_batch_api(
+                db_nodes_to_insert
             )
-
-            # FIX: Filter results to include only nodes from the current document
-            if target_nodes_raw:
-                filtered_target_nodes = [
-                    node
-                    for node in target_nodes_raw
-                    if node.get("document_id") == effective_document_id
-                ]
-                if (
-                    filtered_target_nodes
-                ):  # Only store if results remain after filtering
-                    fuzzy_path_to_nodes_map[path_pattern] = filtered_target_nodes
-
-        except Exception as e_fuzzy:
-            print(
-                f"Error during fuzzy lookup for path pattern '{path_pattern}': {e_fuzzy}",
-                flush=True,
-            )
-            fuzzy_lookup_errors += 1
-    print(
-        f"Batch fuzzy lookups complete. Found nodes for {len(fuzzy_path_to_nodes_map)} paths (after filtering). Errors: {fuzzy_lookup_errors}.",
-        flush=True,
-    )
-
-    # --- Phase 4: Generate Embeddings ---
-    try:
-        print(
-            f"Phase 4: Generating embeddings for {len(db_nodes_to_insert)} nodes...",
-            flush=True,
-        )
-        # generate_node_embeddings adds 'embedding' key to the dicts in the list
-        db_nodes_with_embeddings = embedder.generate_node_embeddings(db_nodes_to_insert)
-        print("Phase 4: Embeddings generated.", flush=True)
-        # Check how many succeeded
-        succeeded_count = sum(
-            1
-            for node in db_nodes_with_embeddings
-            if node.get("metadata", {}).get("embedding_generated")
-        )
-        if succeeded_count < len(db_nodes_with_embeddings):
-            print(
-                f"Warning: Embedding generation failed for {len(db_nodes_with_embeddings) - succeeded_count} nodes.",
-                flush=True,
+        except Exception as e:
+            logger.error(f"Error during Phase 4 (Batch API Embedding Generation): {e}")
+            return None
+        if not precomputed_embeddings:
+            # Nothing could be inserted; keep the document's existing nodes
+            logger.error(
+                "Error during Phase 4 (Batch API Embedding Generation): no embeddings were returned."
             )
-    except Exception as e:
-        print(f"Error during Phase 4 (Embedding Generation): {e}", flush=True)
-        # Decide if we should proceed without embeddings or fail
-        return None  # Fail if embeddings are critical
+            return None
 
-    # --- Phase 4: Insert Nodes into Database ---
-    print(
-        f"Phase 4: Inserting {len(db_nodes_with_embeddings)} nodes into database...",
-        flush=True,
+    # --- Phase 4: Clear Existing Nodes, Generate Embeddings & Insert (Pipelined) ---
+    # Existing nodes for this document ID are cleared concurrently with embedding
+    # and before the first insert
+    logger.info(
+        f"Phase 4: Generating embeddings and inserting {len(db_nodes_to_insert)} nodes into database..."
     )
-    original_id_to_db_id_map: Dict[Any, int] = (
-        {}
-    )  # Map original chunk ID to the new database ID
-    inserted_count = 0
-    failed_count = 0
-
-    # Clear existing nodes for this document ID before inserting new ones
     try:
-        print(
-            f"Clearing existing nodes for document_id: {effective_document_id}...",
-            flush=True,
+        # Map original chunk ID to the new database ID
+        original_id_to_db_id_map, failed_count = asyncio.run(
+            _embed_and_insert_nodes(
+                db,
+                embedder,
+                db_nodes_to_insert,
+                precomputed_embeddings=precomputed_embeddings,
+                clear_document_id=effective_document_id,
+            )
         )
-        deleted_count = db.delete_nodes_by_document_id(effective_document_id)
-        print(f"Cleared {deleted_count} existing nodes.", flush=True)
     except Exception as e:
-        print(
-            f"Error clearing existing nodes for document {effective_document_id}: {e}",
-            flush=True,
+        logger.error(
+            f"Error during Phase 4 (Embedding Generation / Node Insertion): {e}"
         )
-        # Decide whether to proceed or fail if clearing fails
-        # return None # Option: Fail if cleanup is essential
-
-    for node in db_nodes_with_embeddings:
-        original_id = node.get("metadata", {}).get("original_id")
-        if not original_id:
-            print(
-                f"Warning: Skipping node insertion due to missing original_id in metadata: {str(node)[:100]}...",
-                flush=True,
-            )
-            failed_count += 1
-            continue
-
-        # Only insert nodes for which embedding was successful (or if allowing nodes without embeddings)
-        if not node.get("metadata", {}).get("embedding_generated", False):
-            print(
-                f"Skipping insertion for node {original_id} because embedding generation failed.",
-                flush=True,
-            )
-            failed_count += 1
-            continue
-            # OR: If allowing nodes without embeddings, remove the check but handle potential DB constraints
+        return None  # Fail if embeddings are critical
 
-        try:
-            # Remove temporary metadata before insertion if necessary
-            # node_to_insert = node.copy() # Create copy if modifying
-            # node_to_insert.get("metadata", {}).pop("embedding_generated", None) # Example cleanup
-
-            db_id = db.insert_node(node)  # Use the prepared node dict directly
-            original_id_to_db_id_map[original_id] = db_id
-            inserted_count += 1
-            # print(f"Inserted node original_id={original_id} -> db_id={db_id}") # Verbose logging
-        except Exception as e:
-            print(f"Failed to insert node (original_id={original_id}): {e}", flush=True)
-            failed_count += 1
-            # Optionally: Collect failed nodes for retry or reporting
+    inserted_count = len(original_id_to_db_id_map)
 
-    print(
-        f"Phase 4: Node insertion complete. Inserted: {inserted_count}, Failed: {failed_count}.",
-        flush=True,
+    logger.info(
+        f"Phase 4: Node insertion complete. Inserted: {inserted_count}, Failed: {failed_count}."
     )
     if inserted_count == 0 and failed_count > 0:
-        print(
-            "Error: No nodes were successfully inserted into the database.", flush=True
-        )
+        logger.error("No nodes were successfully inserted into the database.")
         return None  # Fail if nothing could be inserted
 
     # --- Phase 4: Create Relationships (Optimized) ---
-    print(
-        "Phase 4: Creating relationships (Optimized - Parent Links & References)...",
-        flush=True,
+    logger.info(
+        "Phase 4: Creating relationships (Optimized - Parent Links & References)..."
     )
     parent_links_set = 0
     references_created = 0
     parent_link_errors = 0
     reference_errors = 0
-    inserted_reference_pairs: Set[Tuple[int, int]] = (
-        set()
-    )  # Track (source_db_id, target_db_id)
 
-    # 1. Set Parent Links (Iterate through inserted nodes)
-    print("Setting parent links...", flush=True)
+    # 1. Set Parent Links (Collect pairs, then one bulk update)
+    logger.info("Setting parent links...")
+    parent_pairs: List[Tuple[int, int]] = []
     for original_id, db_id in original_id_to_db_id_map.items():
         chunk_data = original_id_to_chunk_map.get(original_id)
         if not chunk_data:
@@ -428,103 +694,43 @@ def process_document(
 
         original_parent_id = chunk_data.get("metadata", {}).get("parent_id")
         if original_parent_id and original_parent_id in original_id_to_db_id_map:
-            db_parent_id = original_id_to_db_id_map[original_parent_id]
-            try:
-                # Use the dedicated method in SupabaseManager
-                db.update_node_parent(node_id=db_id, parent_id=db_parent_id)
-                parent_links_set += 1
-            except Exception as e:
-                print(
-                    f"Error setting parent link for node {db_id} (parent: {db_parent_id}): {e}",
-                    flush=True,
-                )
-                parent_link_errors += 1
-
-    # 2. Create References (Combined Pass)
-    print("Creating cross-references (exact and fuzzy)...", flush=True)
-    # Process Exact Matches
-    for source_orig_id, target_orig_id in exact_resolved_references:
-        source_db_id = original_id_to_db_id_map.get(source_orig_id)
-        target_db_id = original_id_to_db_id_map.get(target_orig_id)
-
-        if source_db_id and target_db_id and source_db_id != target_db_id:
-            ref_pair = (source_db_id, target_db_id)
-            if ref_pair not in inserted_reference_pairs:
-                reference_data = {
-                    "source_node_id": source_db_id,
-                    "target_node_id": target_db_id,
-                    "reference_type": "related_section_exact",  # Mark as exact
-                    "strength": 0.9,  # Higher strength for exact?
-                }
-                try:
-                    db.insert_reference(reference_data)
-                    references_created += 1
-                    inserted_reference_pairs.add(ref_pair)
-                except Exception as e_ref:
-                    print(
-                        f"Failed to insert exact reference from {source_db_id} to {target_db_id}: {e_ref}",
-                        flush=True,
-                    )
-                    reference_errors += 1
+            parent_pairs.append((db_id, original_id_to_db_id_map[original_parent_id]))
 
-    # Process Fuzzy Matches
-    for original_id, chunk_data in original_id_to_chunk_map.items():
-        source_db_id = original_id_to_db_id_map.get(original_id)
-        if not source_db_id:
-            continue  # Skip if source node wasn't inserted
-
-        related_sections = chunk_data.get("metadata", {}).get("related_sections", [])
-        for related_path_item in related_sections:  # Renamed variable
-            # FIX: Ensure the key used for lookup is always a string
-            if isinstance(related_path_item, list):
-                path_key_str = " > ".join(map(str, related_path_item))
-            elif isinstance(related_path_item, str):
-                path_key_str = related_path_item
-            else:
-                # Already handled during the exact match phase, but double-check
-                continue
+    if parent_pairs:
+        try:
+            parent_links_set = db.bulk_update_parents(parent_pairs)
+            parent_link_errors = len(parent_pairs) - parent_links_set
+        except Exception as e:
+            logger.error(f"Error setting parent links: {e}")
+            parent_link_errors = len(parent_pairs)
 
-            # Check if this path needed fuzzy lookup and if results were found
-            if path_key_str in fuzzy_path_to_nodes_map:
-                target_nodes = fuzzy_path_to_nodes_map[
-                    path_key_str
-                ]  # These are already filtered
-                for target_node in target_nodes:
-                    target_db_id = target_node.get("id")
-                    # Ensure target_db_id exists in the current map (redundant check, but safe)
-                    if (
-                        target_db_id
-                        and target_db_id in original_id_to_db_id_map.values()
-                        and target_db_id != source_db_id
-                    ):
-                        ref_pair = (source_db_id, target_db_id)
-                        if ref_pair not in inserted_reference_pairs:
-                            reference_data = {
-                                "source_node_id": source_db_id,
-                                "target_node_id": target_db_id,
-                                "reference_type": "related_section_fuzzy",  # Mark as fuzzy
-                                "strength": 0.7,  # Lower strength for fuzzy?
-                            }
-                            try:
-                                db.insert_reference(reference_data)
-                                references_created += 1
-                                inserted_reference_pairs.add(ref_pair)
-                            except Exception as e_ref:
-                                # Avoid double counting errors if exact failed? No, this is a separate attempt.
-                                print(
-                                    f"Failed to insert fuzzy reference from {source_db_id} to {target_db_id} (path: {path_key_str}): {e_ref}",
-                                    flush=True,
-                                )
-                                reference_errors += 1
+    # 2. Create References (single server-side join, client-side fallback)
+    logger.info("Creating cross-references (exact and fuzzy)...")
+    if any(related_paths_by_source.values()):
+        try:
+            references_created = db.build_references_for_document(
+                effective_document_id,
+                node_ids=list(original_id_to_db_id_map.values()),
+            )
+        except Exception as e:
+            logger.warning(
+                f"build_references_for_document RPC failed ({e}). Resolving references client-side."
+            )
+            references_created, reference_errors = _create_references_client_side(
+                db,
+                effective_document_id,
+                related_paths_by_source,
+                path_to_original_id_map,
+                original_id_to_db_id_map,
+            )
 
     # Updated final print statement
-    print(
-        f"Phase 4: Relationship creation complete. Parent links set: {parent_links_set} (Errors: {parent_link_errors}). References created: {references_created} (Errors: {reference_errors}).",
-        flush=True,
+    logger.info(
+        f"Phase 4: Relationship creation complete. Parent links set: {parent_links_set} (Errors: {parent_link_errors}). References created: {references_created} (Errors: {reference_errors})."
     )
 
     # --- Processing Complete ---
-    print(f"\nDocument processing complete for: {effective_document_id}", flush=True)
+    logger.info(f"Document processing complete for: {effective_document_id}")
     return effective_document_id
 
 
@@ -566,11 +772,41 @@ def main():
         "--test-query",
         help="Optional test query to run using the full RetrievalManager after processing.",
     )
+    parser.add_argument(
+        "--batch-api",
+        action="store_true",
+        help="Generate embeddings through the OpenAI Batch API (lower cost, but may take up to 24h).",
+    )
 
     args = parser.parse_args()
 
+    # Progress goes to stdout like the rest of the script's output; the Streamlit
+    # documentation page treats anything on stderr as a failed run
+    log_level_name = (os.getenv("ARCHON_LOG") or "INFO").strip().upper()
+    log_level = logging.getLevelName(log_level_name)  # "Level X" for unknown names
+    if not isinstance(log_level, int):
+        print(
+            f"Warning: unknown ARCHON_LOG level '{log_level_name}', using INFO.",
+            flush=True,
+        )
+        log_level = logging.INFO
+    logging.basicConfig(
+        level=log_level,
+        format="%(levelname)s: %(message)s",
+        stream=sys.stdout,
+    )
+
+    # --- Initialize Components (reused by processing and the test queries) ---
+    try:
+        components = build_components()
+    except Exception as e:
+        print(f"Error initializing components: {e}", flush=True)
+        sys.exit(1)
+
     # --- Process the Document ---
-    processed_doc_id = process_document(args.file, args.id)
+    processed_doc_id = process_document(
+        args.file, args.id, use_batch_api=args.batch_api, components=components
+    )
 
     if not processed_doc_id:
         print("\nDocument processing failed.", flush=True)
@@ -584,7 +820,10 @@ def main():
         print(f"Context Depth (d): {args.context_depth}", flush=True)
 
         try:
-            query_manager = HierarchicalQueryManager()  # Initialize fresh manager
+            query_manager = HierarchicalQueryManager(
+                supabase_manager=components.db,
+                embedding_generator=components.embedder,
+            )  # Reuse the pipeline's managers
             results = query_manager.hierarchical_search(
                 query=args.query,
                 match_count=args.match_count,
@@ -679,7 +918,7 @@ def main():
             response_builder = ResponseBuilder()
             # Instantiate SupabaseManager to provide access to the stored data
             # Note: RetrievalManager._perform_search needs to be implemented to use this client
-            db_client = SupabaseManager()  # Use the existing DB manager
+            db_client = components.db  # Use the existing DB manager
             retrieval_manager = RetrievalManager(
                 search_client=db_client,  # Pass the actual DB client
                 query_processor=query_processor,
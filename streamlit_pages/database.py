@@ -1,43 +1,94 @@
 import streamlit as st
 import sys
-import os
+import re
+from functools import lru_cache
+from pathlib import Path
+from postgrest import APIError
+from postgrest.types import ReturnMethod
 
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Project root, resolved once at import
+_BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.append(str(_BASE_DIR))
 from utils.utils import get_env_var, save_env_var
 
-@st.cache_data
+# Directory holding the SQL files
+_UTILS_DIR = _BASE_DIR / "utils"
+
+# Matches every vector(<dim>) type in the SQL templates, keeping the original case
+_VECTOR_DIM_RE = re.compile(r"\b(vector)\(\d+\)", re.IGNORECASE)
+# Captures the project reference of a hosted project URL (https://<ref>.supabase.co)
+_PROJECT_REF_RE = re.compile(r"https?://([^./]+)\.supabase\.", re.IGNORECASE)
+
+# Drops the site_pages objects ahead of a recreate; {d} is the current vector dimension
+_DROP_TMPL = "DROP FUNCTION IF EXISTS match_site_pages(vector({d}), int, jsonb);\nDROP TABLE IF EXISTS site_pages CASCADE;"
+
+@st.cache_resource(show_spinner=False)
 def load_sql_template():
-    """Load the SQL template file and cache it"""
-    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "utils", "site_pages.sql"), "r") as f:
-        return f.read()
+    """Load the SQL template file and cache it (shared, never mutated)"""
+    return (_UTILS_DIR / "site_pages.sql").read_text(encoding="utf-8")
 
 
-@st.cache_data
+@st.cache_resource(show_spinner=False)
 def load_llms_txt_sql():
-    """Load the llms_txt SQL file and cache it"""
+    """Load the llms_txt SQL file and cache it (shared, never mutated)"""
     try:
-        with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "utils", "llms_txt.sql"), "r") as f:
-            return f.read()
+        return (_UTILS_DIR / "llms_txt.sql").read_text(encoding="utf-8")
     except FileNotFoundError:
         return "Error: utils/llms_txt.sql not found."
 
+@st.cache_resource(show_spinner=False)
+def render_sql(vector_dim):
+    """Render the site_pages SQL for the given embedding dimension and cache it (shared, never mutated)"""
+    return _VECTOR_DIM_RE.sub(rf"\g<1>({vector_dim})", load_sql_template())
+
+@st.cache_resource(show_spinner=False)
+def render_llms_sql(vector_dim):
+    """Render the hierarchical_nodes SQL for the given embedding dimension and cache it (shared, never mutated)"""
+    llms_txt_sql = load_llms_txt_sql()
+    if llms_txt_sql.startswith("Error:"):
+        return llms_txt_sql
+    return _VECTOR_DIM_RE.sub(rf"\g<1>({vector_dim})", llms_txt_sql)
+
+@lru_cache(maxsize=8)
 def get_supabase_sql_editor_url(supabase_url):
     """Get the URL for the Supabase SQL Editor"""
-    try:
-        # Extract the project reference from the URL
-        # Format is typically: https://<project-ref>.supabase.co
-        if '//' in supabase_url and 'supabase' in supabase_url:
-            parts = supabase_url.split('//')
-            if len(parts) > 1:
-                domain_parts = parts[1].split('.')
-                if len(domain_parts) > 0:
-                    project_ref = domain_parts[0]
-                    return f"https://supabase.com/dashboard/project/{project_ref}/sql/new"
-        
-        # Fallback to a generic URL
-        return "https://supabase.com/dashboard"
-    except Exception:
-        return "https://supabase.com/dashboard"
+    # Extract the project reference from the URL
+    # Format is typically: https://<project-ref>.supabase.co
+    match = _PROJECT_REF_RE.match(supabase_url.strip()) if isinstance(supabase_url, str) else None
+    if match:
+        return f"https://supabase.com/dashboard/project/{match.group(1)}/sql/new"
+
+    # Fallback to a generic URL
+    return "https://supabase.com/dashboard"
+
+@st.cache_data(ttl=30, show_spinner=False)
+def _probe_site_pages(_supabase, supabase_url):
+    """Return (has_data, estimated_rows) for the site_pages table, cached for 30 seconds per Supabase URL.
+
+    estimated_rows is None when no usable estimate is available. Raises if the table
+    does not exist; errors are not cached.
+    """
+    # The planner estimate is unreliable for empty or never-analyzed tables, so check for a row first
+    response = _supabase.table("site_pages").select("id").limit(1).execute()
+    if not response.data:
+        return False, 0
+
+    # count="planned" reads the planner's estimate instead of scanning the table for count(*);
+    # head=True asks PostgREST for the count header only, no rows are transferred
+    response = _supabase.table("site_pages").select("id", count="planned", head=True).execute()
+    estimate = response.count
+    return True, estimate if estimate and estimate > 0 else None
+
+def _is_missing_table(err):
+    """Tell whether an error from the status probe means site_pages does not exist"""
+    if isinstance(err, APIError):
+        # 42P01 is Postgres undefined_table; PGRST205 is PostgREST's "table not in schema cache"
+        if err.code in ("42P01", "PGRST205"):
+            return True
+        message = err.message or ""
+    else:
+        message = str(err)
+    return "relation" in message and "does not exist" in message
 
 def show_manual_sql_instructions(sql, vector_dim, recreate=False):
     """Show instructions for manually executing SQL in Supabase"""
@@ -54,12 +105,13 @@ def show_manual_sql_instructions(sql, vector_dim, recreate=False):
     st.markdown("**Step 2:** Create a new SQL query")
     
     if recreate:
-        st.markdown("**Step 3:** Copy and execute the following SQL:")
-        drop_sql = f"DROP FUNCTION IF EXISTS match_site_pages(vector({vector_dim}), int, jsonb);\nDROP TABLE IF EXISTS site_pages CASCADE;"
-        st.code(drop_sql, language="sql")
-        
-        st.markdown("**Step 4:** Then copy and execute this SQL:")
-        st.code(sql, language="sql")
+        st.markdown("**Step 3:** Copy and execute the following SQL in a single run:")
+        drop_sql = _DROP_TMPL.format(d=vector_dim)
+        # One transaction: if the create fails, the drop is rolled back and the old table stays.
+        # The local timeouts stop a drop blocked behind a long-running query from hanging forever.
+        timeouts_sql = "SET LOCAL statement_timeout = '60s';\nSET LOCAL lock_timeout = '5s';"
+        recreate_sql = f"BEGIN;\n{timeouts_sql}\n\n{drop_sql}\n\n{sql}\n\nCOMMIT;"
+        st.code(recreate_sql, language="sql")
     else:
         st.markdown("**Step 3:** Copy and execute the following SQL:")
         st.code(sql, language="sql")
@@ -106,26 +158,23 @@ def database_tab(supabase):
     table_has_data = False
     
     try:
-        # Try to query the table to see if it exists
-        response = supabase.table("site_pages").select("id").limit(1).execute()
+        # Query the table to see if it exists and whether it has data (cached briefly
+        # so widget interactions don't hit the database on every rerun)
+        table_has_data, row_estimate = _probe_site_pages(supabase, get_env_var("SUPABASE_URL"))
         table_exists = True
         
-        # Check if the table has data
-        count_response = supabase.table("site_pages").select("*", count="exact").execute()
-        row_count = count_response.count if hasattr(count_response, 'count') else 0
-        table_has_data = row_count > 0
-        
         st.success("✅ The site_pages table already exists in your database.")
-        if table_has_data:
-            st.info(f"The table contains data ({row_count} rows).")
+        if table_has_data and row_estimate:
+            st.info(f"The table contains data (~{row_estimate} rows).")
+        elif table_has_data:
+            st.info("The table contains data.")
         else:
             st.info("The table exists but contains no data.")
     except Exception as e:
-        error_str = str(e)
-        if "relation" in error_str and "does not exist" in error_str:
+        if _is_missing_table(e):
             st.info("The site_pages table does not exist yet. You can create it below.")
         else:
-            st.error(f"Error checking table status: {error_str}")
+            st.error(f"Error checking table status: {str(e)}")
             st.info("Proceeding with the assumption that the table needs to be created.")
         table_exists = False
     
@@ -140,22 +189,17 @@ def database_tab(supabase):
         help="Use 1536 for OpenAI embeddings, 768 for nomic-embed-text with Ollama, or select another dimension based on your model."
     )
     
-    # Get the SQL with the selected vector dimensions
-    sql_template = load_sql_template()
-    
-    # Replace the vector dimensions in the SQL
-    sql = sql_template.replace("vector(1536)", f"vector({vector_dim})")
-    
-    # Also update the match_site_pages function dimensions
-    sql = sql.replace("query_embedding vector(1536)", f"query_embedding vector({vector_dim})")
+    # Get the SQL with the selected vector dimensions (table column and match_site_pages)
+    sql = render_sql(vector_dim)
     
-    # Show the SQL
-    with st.expander("View SQL", expanded=False):
+    # Show the SQL; only rendered while toggled on, since a collapsed expander
+    # would still send the whole script to the browser on every rerun
+    if st.toggle("View SQL", value=False, key="view_site_pages_sql"):
         st.code(sql, language="sql")
     
     # Create table button
     if not table_exists:
-        if st.button("Get Instructions for Creating Site Pages Table"):
+        if st.button("Get Instructions for Creating Site Pages Table", key="create_instructions"):
             show_manual_sql_instructions(sql, vector_dim)
     else:
         # Option to recreate the table or clear data
@@ -163,23 +207,25 @@ def database_tab(supabase):
         
         with col1:
             st.warning("⚠️ Recreating will delete all existing data.")
-            if st.button("Get Instructions for Recreating Site Pages Table"):
+            if st.button("Get Instructions for Recreating Site Pages Table", key="recreate_instructions"):
                 show_manual_sql_instructions(sql, vector_dim, recreate=True)
         
         with col2:
             if table_has_data:
                 st.warning("⚠️ Clear all data but keep structure.")
-                if st.button("Clear Table Data"):
+                if st.button("Clear Table Data", key="clear_table_data"):
                     try:
                         with st.spinner("Clearing table data..."):
-                            # Use the Supabase client to delete all rows
-                            response = supabase.table("site_pages").delete().neq("id", 0).execute()
+                            # Use the Supabase client to delete all rows; return=minimal
+                            # keeps PostgREST from sending every deleted row back
+                            supabase.table("site_pages").delete(returning=ReturnMethod.minimal).neq("id", 0).execute()
+                            _probe_site_pages.clear()
                             st.success("✅ Table data cleared successfully!")
                             st.rerun()
                     except Exception as e:
                         st.error(f"Error clearing table data: {str(e)}")
                         # Fall back to manual SQL
-                        truncate_sql = "TRUNCATE TABLE site_pages;"
+                        truncate_sql = "TRUNCATE TABLE site_pages RESTART IDENTITY;"
                         st.code(truncate_sql, language="sql")
                         st.info("Execute this SQL in your Supabase SQL Editor to clear the table data.")
                         
@@ -255,15 +301,12 @@ def database_tab(supabase):
         3.  **Important:** Adjust the `VECTOR(1536)` dimension in the SQL below if your embedding model uses a different dimension (e.g., 768 for `nomic-embed-text`).
         """)
         
-        # Load and display the llms_txt SQL
-        llms_txt_sql = load_llms_txt_sql()
-        if "Error:" in llms_txt_sql:
+        # Load and display the llms_txt SQL, using the same vector dimension as site_pages
+        llms_txt_sql = render_llms_sql(vector_dim)
+        if llms_txt_sql.startswith("Error:"):
             st.error(llms_txt_sql)
         else:
-            # Replace vector dimension placeholder if needed (similar to site_pages)
-            # Assuming the same vector_dim variable applies, otherwise fetch separately
-            llms_txt_sql_adjusted = llms_txt_sql.replace("VECTOR(1536)", f"VECTOR({vector_dim})")
-            st.code(llms_txt_sql_adjusted, language="sql")
+            st.code(llms_txt_sql, language="sql")
 
         # Provide a link to the Supabase SQL Editor
         supabase_url = get_env_var("SUPABASE_URL")
@@ -273,3 +316,6 @@ def database_tab(supabase):
         else:
             st.warning("Configure Supabase URL in Environment tab to get a direct link to the SQL Editor.")
 
+# Read the SQL files at import so the first render does not wait on disk
+load_sql_template()
+load_llms_txt_sql()
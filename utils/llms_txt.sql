@@ -282,4 +282,144 @@ CREATE POLICY "Allow authenticated update" ON hierarchical_references
     FOR UPDATE TO authenticated USING (true);
     
 CREATE POLICY "Allow authenticated delete" ON hierarchical_references 
-    FOR DELETE TO authenticated USING (true);
\ No newline at end of file
+    FOR DELETE TO authenticated USING (true);
+
+-- 12. Add function to set many parent links in one call
+-- pairs: JSON array of {"id": <node id>, "parent_id": <parent node id>} objects
+CREATE OR REPLACE FUNCTION bulk_set_parents(pairs JSONB)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    updated_count INTEGER;
+BEGIN
+    UPDATE hierarchical_nodes n
+    SET parent_id = p.parent_id
+    FROM jsonb_to_recordset(pairs) AS p(id BIGINT, parent_id BIGINT)
+    WHERE n.id = p.id;
+
+    GET DIAGNOSTICS updated_count = ROW_COUNT;
+    RETURN updated_count;
+END;
+$$;
+
+
+-- 13. Add function to find nodes for many path patterns in one call
+CREATE OR REPLACE FUNCTION find_nodes_by_paths(
+    path_patterns TEXT[],
+    p_document_id VARCHAR,
+    max_results_per_pattern INT DEFAULT 10
+)
+RETURNS TABLE (
+    path_pattern TEXT,
+    id BIGINT,
+    document_id VARCHAR,
+    node_type VARCHAR,
+    title VARCHAR,
+    path TEXT,
+    level INTEGER,
+    section_type VARCHAR
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    RETURN QUERY
+    SELECT
+        p.pattern, m.id, m.document_id, m.node_type, m.title, m.path, m.level, m.section_type
+    FROM unnest(path_patterns) AS p(pattern)
+    CROSS JOIN LATERAL (
+        SELECT
+            n.id, n.document_id, n.node_type, n.title, n.path, n.level, n.section_type
+        FROM hierarchical_nodes n
+        WHERE n.document_id = p_document_id
+            AND n.path ILIKE '%' || p.pattern || '%'
+        ORDER BY n.path
+        LIMIT max_results_per_pattern
+    ) m;
+END;
+$$;
+
+
+-- 14. Add function to build all related-section references of a document in one call
+-- Resolves the normalized paths stored in each node's metadata->'related_paths':
+-- exact path matches first, then ILIKE matches for paths without an exact target
+CREATE OR REPLACE FUNCTION build_references_for_document(
+    p_document_id VARCHAR,
+    p_node_ids BIGINT[],
+    max_fuzzy_matches_per_path INT DEFAULT 10
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    inserted_count INTEGER;
+BEGIN
+    WITH doc_nodes AS (
+        SELECT n.id, n.path, n.metadata
+        FROM hierarchical_nodes n
+        WHERE n.document_id = p_document_id
+            AND n.id = ANY(p_node_ids)
+    ),
+    related AS (
+        SELECT DISTINCT s.id AS source_id, r.related_path
+        FROM doc_nodes s
+        CROSS JOIN LATERAL jsonb_array_elements_text(
+            COALESCE(s.metadata->'related_paths', '[]'::JSONB)
+        ) AS r(related_path)
+        WHERE r.related_path <> ''
+    ),
+    exact_targets AS (
+        -- One target per path: the last node written with exactly that path
+        SELECT DISTINCT ON (rel.source_id, rel.related_path)
+            rel.source_id, rel.related_path, t.id AS target_id
+        FROM related rel
+        JOIN doc_nodes t ON t.path = rel.related_path
+        ORDER BY rel.source_id, rel.related_path, t.id DESC
+    ),
+    exact_refs AS (
+        SELECT DISTINCT e.source_id, e.target_id
+        FROM exact_targets e
+        WHERE e.target_id <> e.source_id
+    ),
+    fuzzy_refs AS (
+        SELECT DISTINCT rel.source_id, m.id AS target_id
+        FROM related rel
+        CROSS JOIN LATERAL (
+            SELECT t.id
+            FROM doc_nodes t
+            WHERE t.path ILIKE '%' || rel.related_path || '%'
+            ORDER BY t.path
+            LIMIT max_fuzzy_matches_per_path
+        ) m
+        WHERE m.id <> rel.source_id
+            AND NOT EXISTS (
+                SELECT 1 FROM exact_targets e
+                WHERE e.source_id = rel.source_id
+                    AND e.related_path = rel.related_path
+            )
+    ),
+    new_refs AS (
+        SELECT x.source_id, x.target_id,
+            'related_section_exact'::VARCHAR AS reference_type, 0.9::FLOAT AS strength
+        FROM exact_refs x
+        UNION ALL
+        SELECT f.source_id, f.target_id, 'related_section_fuzzy'::VARCHAR, 0.7::FLOAT
+        FROM fuzzy_refs f
+        WHERE NOT EXISTS (
+            SELECT 1 FROM exact_refs x
+            WHERE x.source_id = f.source_id AND x.target_id = f.target_id
+        )
+    )
+    INSERT INTO hierarchical_references (source_node_id, target_node_id, reference_type, strength)
+    SELECT nr.source_id, nr.target_id, nr.reference_type, nr.strength
+    FROM new_refs nr
+    WHERE NOT EXISTS (
+        SELECT 1 FROM hierarchical_references hr
+        WHERE hr.source_node_id = nr.source_id
+            AND hr.target_node_id = nr.target_id
+    );
+
+    GET DIAGNOSTICS inserted_count = ROW_COUNT;
+    RETURN inserted_count;
+END;
+$$;
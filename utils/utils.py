@@ -2,7 +2,7 @@ from supabase import Client, create_client
 from openai import AsyncOpenAI
 from dotenv import load_dotenv
 from datetime import datetime
-from functools import wraps
+from functools import lru_cache, wraps
 from typing import Optional
 import streamlit as st
 import webbrowser
@@ -37,6 +37,17 @@ def write_to_log(message: str):
     with open(log_path, "a", encoding="utf-8") as f:
         f.write(log_entry)
 
+@lru_cache(maxsize=4)
+def _read_env_file(env_file_path: str, mtime_ns: int, size: int) -> dict:
+    """Parse the env_vars.json file, memoized per file version.
+    
+    The modification time and size are part of the cache key, so changes made by
+    other processes are picked up; the writers below also clear the cache.
+    The returned dict is shared and must not be mutated.
+    """
+    with open(env_file_path, "r") as f:
+        return json.load(f)
+
 def get_env_var(var_name: str, profile: Optional[str] = None) -> Optional[str]:
     """Get an environment variable from the saved JSON file or from environment variables.
     
@@ -53,21 +64,22 @@ def get_env_var(var_name: str, profile: Optional[str] = None) -> Optional[str]:
     # First try to get from JSON file
     if os.path.exists(env_file_path):
         try:
-            with open(env_file_path, "r") as f:
-                env_vars = json.load(f)
-                
-                # If profile is specified, use it; otherwise use current profile
-                current_profile = profile or env_vars.get("current_profile", "default")
-                
-                # Get variables for the profile
-                if "profiles" in env_vars and current_profile in env_vars["profiles"]:
-                    profile_vars = env_vars["profiles"][current_profile]
-                    if var_name in profile_vars and profile_vars[var_name]:
-                        return profile_vars[var_name]
-                
-                # For backward compatibility, check the root level
-                if var_name in env_vars and env_vars[var_name]:
-                    return env_vars[var_name]
+            # Only re-read and parse the file when it has changed since the last lookup
+            stat = os.stat(env_file_path)
+            env_vars = _read_env_file(env_file_path, stat.st_mtime_ns, stat.st_size)
+            
+            # If profile is specified, use it; otherwise use current profile
+            current_profile = profile or env_vars.get("current_profile", "default")
+            
+            # Get variables for the profile
+            if "profiles" in env_vars and current_profile in env_vars["profiles"]:
+                profile_vars = env_vars["profiles"][current_profile]
+                if var_name in profile_vars and profile_vars[var_name]:
+                    return profile_vars[var_name]
+            
+            # For backward compatibility, check the root level
+            if var_name in env_vars and env_vars[var_name]:
+                return env_vars[var_name]
         except (json.JSONDecodeError, IOError) as e:
             write_to_log(f"Error reading env_vars.json: {str(e)}")
     
@@ -121,6 +133,7 @@ def save_env_var(var_name: str, value: str, profile: Optional[str] = None) -> bo
     try:
         with open(env_file_path, "w") as f:
             json.dump(env_vars, f, indent=2)
+        _read_env_file.cache_clear()
         return True
     except IOError as e:
         write_to_log(f"Error writing to env_vars.json: {str(e)}")
@@ -181,6 +194,7 @@ def set_current_profile(profile_name: str) -> bool:
     try:
         with open(env_file_path, "w") as f:
             json.dump(env_vars, f, indent=2)
+        _read_env_file.cache_clear()
         return True
     except IOError as e:
         write_to_log(f"Error writing to env_vars.json: {str(e)}")
@@ -240,6 +254,7 @@ def create_profile(profile_name: str) -> bool:
         try:
             with open(env_file_path, "w") as f:
                 json.dump(env_vars, f, indent=2)
+            _read_env_file.cache_clear()
             return True
         except IOError as e:
             write_to_log(f"Error writing to env_vars.json: {str(e)}")
@@ -279,6 +294,7 @@ def delete_profile(profile_name: str) -> bool:
                 # Save back to file
                 with open(env_file_path, "w") as f:
                     json.dump(env_vars, f, indent=2)
+                _read_env_file.cache_clear()
                 return True
         except (json.JSONDecodeError, IOError) as e:
             write_to_log(f"Error reading/writing env_vars.json: {str(e)}")
@@ -380,6 +396,22 @@ def reload_archon_graph(show_reload_success=True):
         st.error(f"Error reloading Archon modules: {str(e)}")
         return False        
 
+@st.cache_resource(show_spinner=False)
+def get_supabase_client(supabase_url: str, supabase_key: str) -> Client:
+    """Get a Supabase client shared across Streamlit reruns and sessions.
+
+    The client and its HTTP connection pool are created once per URL/key pair;
+    failures are not cached, so a corrected configuration is picked up on retry.
+
+    Args:
+        supabase_url: The Supabase project URL
+        supabase_key: The Supabase service key
+
+    Returns:
+        Client: The cached Supabase client
+    """
+    return Client(supabase_url, supabase_key)
+
 def get_clients():
     # LLM client setup
     embedding_client = None
@@ -401,7 +433,7 @@ def get_clients():
     supabase_key = get_env_var("SUPABASE_SERVICE_KEY")
     if supabase_url and supabase_key:
         try:
-            supabase: Client = Client(supabase_url, supabase_key)
+            supabase: Client = get_supabase_client(supabase_url, supabase_key)
         except Exception as e:
             print(f"Failed to initialize Supabase: {e}")
             write_to_log(f"Failed to initialize Supabase: {e}")